@@ -1,9 +1,104 @@
+import codecs
 import json
 import logging as log
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from shutil import copy
+from shutil import copy, copymode
+from tempfile import NamedTemporaryFile
 from typing import Self
 
+# rewrite the title= line of a single chart file
+# new contents are written to a temp file in the same directory, then renamed over the original
+# so an interrupted write never leaves a half-written chart behind
+def rewrite_chart_title(chart_path: Path, new_title: str):
+    # work on raw bytes so the BOM, line endings and any non-utf-8 bytes survive untouched
+    data = chart_path.read_bytes()
+    bom = b''
+    if data.startswith(codecs.BOM_UTF8):
+        bom = codecs.BOM_UTF8
+        data = data[len(bom):]
+
+    # only look for title= in the metadata header, which ends at the first '--' line
+    lines = data.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        stripped = line.rstrip(b'\r\n')
+        if stripped == b'--':
+            break
+        if stripped[:6] == b'title=':
+            line_ending = line[len(stripped):]
+            lines[i] = b'title=' + new_title.encode('utf-8') + line_ending
+            break
+
+    with NamedTemporaryFile('wb', dir=chart_path.parent, prefix=f'.{chart_path.name}.', suffix='.tmp', delete=False) as temp:
+        temp_path = Path(temp.name)
+        try:
+            temp.write(bom)
+            temp.writelines(lines)
+        except:
+            temp.close()
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    try:
+        copymode(chart_path, temp_path)
+        os.replace(temp_path, chart_path)
+    except:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+# apply a batch of (chart path, new title) rewrites in parallel
+# returns the chart paths that could not be rewritten
+def rewrite_chart_titles(rewrites: list[tuple[Path, str]], max_workers: int = None) -> list[Path]:
+    failed = []
+    if not rewrites:
+        return failed
+
+    log.info(f'Rewriting title metadata of {len(rewrites)} chart files')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(path, executor.submit(rewrite_chart_title, path, title)) for (path, title) in rewrites]
+        for (path, future) in futures:
+            try:
+                future.result()
+            except OSError as e:
+                log.warn(f'Failed to rewrite title of {path}: {e}')
+                failed.append(path)
+
+    return failed
+
+# snapshot of a directory's file listing, taken with a single scandir
+# used to resolve a song's asset names without stat-ing each file separately
+class DirectorySnapshot:
+    def __init__(self, path: Path) -> Self:
+        self.path = path
+        # exact filename -> filename, and case-folded filename -> filename
+        self.names = {}
+        self.folded = {}
+
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self.names[entry.name] = entry.name
+                        # keep the first match if several files differ only by case
+                        self.folded.setdefault(entry.name.casefold(), entry.name)
+        except FileNotFoundError:
+            log.warn(f'Directory {path} does not exist!')
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    # find the actual file for an asset name, falling back to a case-insensitive match
+    # since many converts were authored on windows; returns None if the file is missing
+    def resolve(self, name: str) -> Path | None:
+        actual = self.names.get(name) or self.folded.get(name.casefold())
+        return self.path / actual if actual else None
+
+    # record a file as present, e.g. after copying it into the directory
+    def add(self, name: str):
+        self.names[name] = name
+        self.folded.setdefault(name.casefold(), name)
+
 # class for a single .ksh chart file's metadata
 class SDVXChart:
     fields = {
@@ -125,7 +220,9 @@ class SDVXSong:
         'infinite': 3
     }
 
-    def __init__(self, song_dir: Path = None, json_dict: dict = None, include_sfx: bool = True) -> Self:
+    # if a rewrites list is provided, chart title fixes are appended to it
+    # instead of being written immediately, so they can be applied in one batch
+    def __init__(self, song_dir: Path = None, json_dict: dict = None, include_sfx: bool = True, rewrites: list = None) -> Self:
         assert(song_dir and song_dir.exists() or json_dict)
         self.dirname = song_dir or Path(json_dict['dirname'])
         self.title = None
@@ -174,14 +271,16 @@ class SDVXSong:
                             '\n'.join([f'[{num}] {title}' for (num, title) in enumerate(conflict_list)])\
                         }')
                         number = int(input('Please type a number to specify correct title: '))
-                        self.update_title(chart, conflict_list[number])
+                        self.update_title(conflict_list[number], rewrites)
                         break
                     except:
                         log.warn('Invalid entry!')
 
     # update song title for all chart files
-    def update_title(self, new_title: str):
+    # if a rewrites list is provided, file rewrites are queued on it instead of applied here
+    def update_title(self, new_title: str, rewrites: list = None):
         self.title = new_title
+        pending = []
         for chart in self.charts:
             # only update chart data if title doesn't match new one
             if chart and chart.title != new_title:
@@ -196,16 +295,12 @@ class SDVXSong:
                 else:
                     full_path = self.dirname / chart.filename
 
-                # read all lines and find line containing title=, then update title
-                with full_path.open('r+', encoding='utf-8-sig', errors='ignore') as file:
-                    lines = file.readlines()
-                    for i, line in enumerate(lines):
-                        if line[:6] == 'title=':
-                            lines[i] = f'title={new_title}\n'
-                            break
+                pending.append((full_path, new_title))
 
-                    file.seek(0)
-                    file.writelines(lines)
+        if rewrites is not None:
+            rewrites.extend(pending)
+        else:
+            rewrite_chart_titles(pending)
 
     # convert object to serializable dict
     def to_json(self) -> dict:
@@ -229,24 +324,42 @@ class SDVXSong:
         return chart.get_files() if chart else []
 
     # copy song files over to a new directory
-    def copy_song(self, dest_dir: Path):
+    # returns the names of any files referenced by charts that could not be found
+    def copy_song(self, dest_dir: Path) -> list[str]:
+        # take one directory listing per source directory and one of dest_dir
+        # rather than stat-ing every file individually
+        snapshots = {}
+        dest = DirectorySnapshot(dest_dir)
+        missing = []
+
         for chart in self.charts:
             if chart:
                 # check if difficulty is hosted at different directory
                 chart_directory = self.dirname
                 if chart.custom_path:
                     chart_directory = chart.filename.parent
+                if chart_directory not in snapshots:
+                    snapshots[chart_directory] = DirectorySnapshot(chart_directory)
+                source = snapshots[chart_directory]
 
                 # copy files over
-                for file in self.get_difficulty_files(chart.difficulty):
+                for file in chart.get_files():
                     file_name = Path(file).name
-                    full_file_path = chart_directory / file_name
-                    
+
                     # check if file does not already exist in dest_dir
-                    # otherwise copy it over
-                    dest_file_path = dest_dir / file_name
-                    if not dest_file_path.exists():
-                        copy(full_file_path, dest_file_path)
+                    # otherwise copy it over under the name the chart refers to
+                    if file_name in dest:
+                        continue
+                    full_file_path = source.resolve(file_name)
+                    if not full_file_path:
+                        missing.append(file_name)
+                        continue
+                    copy(full_file_path, dest_dir / file_name)
+                    dest.add(file_name)
+
+        if missing:
+            log.warn(f'Song {self.title} at {self.dirname} is missing files: {', '.join(missing)}')
+        return missing
 
 # master class representing a collection of song folders
 class SDVXCollection:
@@ -271,13 +384,16 @@ class SDVXCollection:
             self.collection = {}
 
             # iterate through all directories in collection dir and init
-            self.init_folder(collection_dir, include_sfx)
+            # title fixes from every song are collected and written in one parallel batch
+            rewrites = []
+            self.init_folder(collection_dir, include_sfx, rewrites)
+            rewrite_chart_titles(rewrites)
 
     # check for the presence of .ksh files in directory
     def is_song_directory(song_dir: Path) -> bool:
         return bool(next(song_dir.glob('*.ksh'), False))
     
-    def init_folder(self, collection_dir: Path, include_sfx: bool):
+    def init_folder(self, collection_dir: Path, include_sfx: bool, rewrites: list = None):
         # iterate through dir contents
         for songdir in collection_dir.iterdir():
             if songdir.is_dir():
@@ -285,7 +401,7 @@ class SDVXCollection:
                 # otherwise, recursive call init_folder on subfolder
                 if SDVXCollection.is_song_directory(songdir):
                     log.debug(f'Initiating SDVXSong at {songdir}')
-                    song = SDVXSong(song_dir=songdir, include_sfx=include_sfx)
+                    song = SDVXSong(song_dir=songdir, include_sfx=include_sfx, rewrites=rewrites)
 
                     # if song title does not exist in collection, add it
                     # otherwise, attempt to merge SDVXSongs into one
@@ -301,7 +417,7 @@ class SDVXCollection:
                             log.info('Failed to merge songs')
                 else:
                     log.warn(f'Directory {songdir} is not a song directory!')
-                    self.init_folder(songdir, include_sfx)
+                    self.init_folder(songdir, include_sfx, rewrites)
 
     # merge song folders that contain INF/GRV/VVD/XCD difficulties with their regular counterparts
     # returns the main song path to be used